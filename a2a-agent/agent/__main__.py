@@ -20,6 +20,7 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 
 from .a2ui_extension import get_a2ui_agent_extension
+from .agent import close_client
 from .agent_executor import UIGeneratorExecutor
 
 # Load environment variables
@@ -136,6 +137,9 @@ def main(host: str, port: int):
     )
     app = server.build()
 
+    # Release the shared Anthropic connection pool on shutdown
+    app.add_event_handler("shutdown", close_client)
+
     # Add CORS middleware for cross-origin requests
     app.add_middleware(
         CORSMiddleware,
@@ -1,17 +1,41 @@
 # agent.py
+import asyncio
+import functools
+import hashlib
 import json
 import logging
 import os
+import re
 from collections.abc import AsyncIterable
-from typing import Any
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Any
 
-import anthropic
-import jsonschema
+import orjson
 
 from .prompt_builder import A2UI_SCHEMA, UI_EXAMPLES
 
+# anthropic and jsonschema are slow to import, so they are loaded on first use
+if TYPE_CHECKING:
+    import anthropic
+
 logger = logging.getLogger(__name__)
 
+# Separates the prelude sentence from the A2UI JSON array in Claude's response
+A2UI_DELIMITER = "---a2ui_JSON---"
+
+# Minimum number of new characters before another streaming update is emitted
+STREAM_UPDATE_CHARS = 512
+
+# Seconds between Message Batches API status checks in generate_batch()
+BATCH_POLL_INTERVAL = 30.0
+
+# Maximum number of validated A2UI responses kept per agent for repeated requests
+EXTRACTION_CACHE_SIZE = 128
+
+# Bounds on the prior conversation sent with each request, so prompt size stays flat
+MAX_HISTORY_TURNS = 8
+MAX_HISTORY_CHARS = 16000
+
 try:
     _single_schema = json.loads(A2UI_SCHEMA)
     A2UI_SCHEMA_OBJECT = {"type": "array", "items": _single_schema}
@@ -28,7 +52,6 @@ One short sentence describing the UI.
 ---a2ui_JSON---
 [A2UI JSON array here]
 
-RULES:
 RULES:
 0. COMPANY NAME — MANDATORY: The very first component in EVERY UI must be an h1 Text with an invented fictional company name. Examples: "Synapse Labs", "Cortex AI", "Luminary Systems", "Apex Neural". NEVER use generic text like "AI Startup" or "Join Our Team" as the h1.
 00. FORBIDDEN h1 values: "AI Startup", "Our Company", "Join Our Team", "Contact Us", "Application Form", "Dashboard". These are BANNED as h1 text.
@@ -73,6 +96,87 @@ FULL EXAMPLES TO COPY FROM:
 {UI_EXAMPLES}
 """
 
+# Encoded once for request hashing; the SDK only accepts str text blocks
+SYSTEM_PROMPT_BYTES = SYSTEM_PROMPT.encode()
+
+# SYSTEM_PROMPT never changes between calls, so mark it as a cacheable prefix.
+# Shared by every agent instance rather than rebuilt per instance.
+_SYSTEM_BLOCKS = [
+    {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+]
+
+
+@functools.cache
+def _get_client() -> "anthropic.AsyncAnthropic":
+    """Return the process-wide AsyncAnthropic client so all agents share one connection pool."""
+    import anthropic
+
+    # Built from the SDK's own Limits type, since its HTTP library differs between releases
+    limits = type(anthropic.DEFAULT_CONNECTION_LIMITS)(max_connections=100, max_keepalive_connections=50)
+    # Created lazily so the API key is read after __main__ has run load_dotenv()
+    http_client = anthropic.DefaultAsyncHttpxClient(http2=True, limits=limits)
+    return anthropic.AsyncAnthropic(api_key=os.getenv("ANTHROPIC_API_KEY"), http_client=http_client)
+
+
+async def close_client() -> None:
+    """Close the shared Anthropic client and its HTTP connection pool, if it was created."""
+    if _get_client.cache_info().currsize:
+        await _get_client().close()
+        _get_client.cache_clear()
+
+
+class _ArrayElementScanner:
+    """Incrementally find complete top-level elements of a JSON array as its text streams in."""
+
+    _STRUCTURAL = re.compile(r'[\\"{}\[\]]')
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0  # next index of _buffer to scan
+        self._skip = 0  # index of an escaped character inside a string
+        self._depth = 0  # 0 = before the array, 1 = between elements
+        self._in_string = False
+        self._start = None  # start of the element being received
+
+    def feed(self, text: str) -> list[str]:
+        """Add streamed text and return the raw JSON of every element it completes."""
+        self._buffer += text
+        elements = []
+        for match in self._STRUCTURAL.finditer(self._buffer, self._pos):
+            i = match.start()
+            if i < self._skip:
+                continue
+            char = match.group()
+            if self._in_string:
+                if char == "\\":
+                    self._skip = i + 2
+                elif char == '"':
+                    self._in_string = False
+                continue
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._start is None:
+                    self._start = i
+            elif char in "{[":
+                if self._depth == 1:
+                    self._start = i
+                self._depth += 1
+            elif self._depth > 0:
+                self._depth -= 1
+                if self._depth == 1 and self._start is not None:
+                    elements.append(self._buffer[self._start : i + 1])
+                    self._start = None
+        self._pos = len(self._buffer)
+
+        # Only the element still being received needs to be kept
+        keep_from = self._pos if self._start is None else self._start
+        self._buffer = self._buffer[keep_from:]
+        self._pos -= keep_from
+        self._skip = max(self._skip - keep_from, 0)
+        if self._start is not None:
+            self._start = 0
+        return elements
+
 
 class UIGeneratorAgent:
     SUPPORTED_CONTENT_TYPES = ["text", "text/plain"]
@@ -80,56 +184,186 @@ class UIGeneratorAgent:
     def __init__(self, base_url: str, use_ui: bool = True):
         self.base_url = base_url
         self.use_ui = use_ui
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        self.client = _get_client()
         self.model = os.getenv("LITELLM_MODEL", "claude-sonnet-4-5").replace("anthropic/", "")
         self.a2ui_schema_object = A2UI_SCHEMA_OBJECT
+        # Full JSON Schema validation is a debugging aid; the hot path uses _fast_validate
+        self.strict_validation = os.getenv("A2UI_STRICT_VALIDATION", "").lower() in ("1", "true", "yes")
+        # Compile the validator once; jsonschema.validate() would rebuild it on every call
+        self._validator = None
+        if self.strict_validation and A2UI_SCHEMA_OBJECT is not None:
+            from jsonschema import Draft202012Validator
+
+            Draft202012Validator.check_schema(A2UI_SCHEMA_OBJECT)
+            self._validator = Draft202012Validator(A2UI_SCHEMA_OBJECT)
+        self._system_blocks = _SYSTEM_BLOCKS
+        # Validated (text, A2UI messages) per request key, oldest first
+        self._cache: dict[str, tuple[str, list]] = {}
         logger.info(f"UIGeneratorAgent initialized with model: {self.model}")
 
     def get_processing_message(self) -> str:
         return "Generating your UI..."
 
-    def _extract_a2ui(self, text: str) -> list | None:
-        if "---a2ui_JSON---" not in text:
+    def _extract_a2ui(self, text: str) -> tuple[str, list] | None:
+        prefix, sep, json_part = text.partition(A2UI_DELIMITER)
+        if not sep:
             logger.warning("Delimiter ---a2ui_JSON--- not found in response")
             return None
 
-        _, json_part = text.split("---a2ui_JSON---", 1)
         json_part = json_part.strip()
 
         if json_part.startswith("```"):
-            lines = json_part.split("\n")
-            lines = [l for l in lines if not l.strip().startswith("```")]
-            json_part = "\n".join(lines).strip()
+            json_part = json_part.removeprefix("```json").removeprefix("```").strip()
+            if json_part.endswith("```"):
+                json_part = json_part.removesuffix("```").strip()
 
         try:
-            parsed = json.loads(json_part)
+            parsed = orjson.loads(json_part)
             if isinstance(parsed, list) and len(parsed) > 0:
-                return parsed
+                return prefix.strip(), parsed
             logger.warning("Parsed JSON is not a non-empty list")
             return None
-        except json.JSONDecodeError as e:
-            logger.error(f"JSON parse error: {e}\nRaw: {json_part[:300]}")
+        except orjson.JSONDecodeError as e:
+            if logger.isEnabledFor(logging.ERROR):
+                logger.error("JSON parse error: %s\nRaw: %s", e, json_part[:300])
             return None
 
+    def _format_a2ui(self, text_part: str, extracted: list) -> str:
+        """Serialize validated A2UI messages back into the delimited response format."""
+        return f"{text_part}\n{A2UI_DELIMITER}\n{orjson.dumps(extracted).decode()}"
+
+    def _discard_partials(self, partials: list) -> dict[str, Any]:
+        """Build an update deleting every surface a rejected attempt already streamed."""
+        surface_ids = dict.fromkeys(
+            message[action]["surfaceId"]
+            for message in partials
+            for action in ("beginRendering", "surfaceUpdate", "dataModelUpdate", "deleteSurface")
+            if action in message
+        )
+        return {
+            "is_task_complete": False,
+            "a2ui_messages": [{"deleteSurface": {"surfaceId": surface_id}} for surface_id in surface_ids],
+        }
+
+    def _message_error(self, message: Any) -> str | None:
+        """Check one A2UI message against the required fields of the schema; return an error or None."""
+        if not isinstance(message, dict):
+            return "Every A2UI message must be a JSON object"
+
+        if "beginRendering" in message:
+            begin = message["beginRendering"]
+            if (
+                not isinstance(begin, dict)
+                or not isinstance(begin.get("surfaceId"), str)
+                or not isinstance(begin.get("root"), str)
+            ):
+                return "beginRendering requires string 'surfaceId' and 'root'"
+        elif "surfaceUpdate" in message:
+            update = message["surfaceUpdate"]
+            if not isinstance(update, dict) or not isinstance(update.get("surfaceId"), str):
+                return "surfaceUpdate requires a string 'surfaceId'"
+            components = update.get("components")
+            if not isinstance(components, list) or not components:
+                return "surfaceUpdate requires a non-empty 'components' list"
+            for component in components:
+                if (
+                    not isinstance(component, dict)
+                    or not isinstance(component.get("id"), str)
+                    or not isinstance(component.get("component"), dict)
+                ):
+                    return "Every component requires a string 'id' and an object 'component'"
+        elif "dataModelUpdate" in message:
+            data_update = message["dataModelUpdate"]
+            if (
+                not isinstance(data_update, dict)
+                or not isinstance(data_update.get("surfaceId"), str)
+                or not isinstance(data_update.get("contents"), list)
+            ):
+                return "dataModelUpdate requires a string 'surfaceId' and a 'contents' list"
+        elif "deleteSurface" in message:
+            delete = message["deleteSurface"]
+            if not isinstance(delete, dict) or not isinstance(delete.get("surfaceId"), str):
+                return "deleteSurface requires a string 'surfaceId'"
+        else:
+            return "A2UI message must contain beginRendering, surfaceUpdate, dataModelUpdate or deleteSurface"
+        return None
+
+    def _fast_validate(self, extracted: list) -> str | None:
+        """Check the beginRendering / surfaceUpdate / dataModelUpdate shape; return an error or None."""
+        if not extracted:
+            return "A2UI array is empty"
+        for message in extracted:
+            error = self._message_error(message)
+            if error is not None:
+                return error
+
+        if "beginRendering" not in extracted[0]:
+            return "First message must be beginRendering"
+        if not any("surfaceUpdate" in m for m in extracted):
+            return "Missing surfaceUpdate message"
+        if not any("dataModelUpdate" in m for m in extracted):
+            return "Missing dataModelUpdate message"
+        return None
+
+    def _validate_a2ui(self, extracted: list) -> str | None:
+        """Validate extracted A2UI messages, returning the first error message or None."""
+        error = self._fast_validate(extracted)
+        if error is None and self._validator is not None and not self._validator.is_valid(extracted):
+            from jsonschema.exceptions import best_match
+
+            # Only build an error for the retry prompt once we know it is invalid; best_match
+            # picks the same error jsonschema.validate() would have raised
+            error = best_match(self._validator.iter_errors(extracted)).message
+        return error
+
+    def _cache_key(self, messages: list) -> str | None:
+        """Content-address a request by the messages actually sent, or None if they cannot be hashed."""
+        try:
+            parts = [self.model.encode(), SYSTEM_PROMPT_BYTES, orjson.dumps(messages)]
+        except (TypeError, UnicodeEncodeError) as e:
+            # e.g. out-of-range integers or lone surrogates in client-supplied history
+            logger.warning(f"Skipping extraction cache, request not hashable: {e}")
+            return None
+        # Length-prefix each part so different splits of the same bytes never collide
+        return hashlib.sha256(b"".join(len(p).to_bytes(8, "big") + p for p in parts)).hexdigest()
+
     def _build_messages(self, query: str, conversation_history: list) -> list:
         """Build Anthropic messages array including prior conversation context."""
-        messages = []
-
         # Inject prior turns so Claude remembers what it built
-        for turn in conversation_history:
-            role = turn.get("role", "user")
-            content = turn.get("content", "")
-            if role in ("user", "assistant") and content:
-                messages.append({"role": role, "content": content})
-
-        # Force company name invention at the query level — most reliable injection point
-        enhanced_query = (
-            f"{query}\n\n"
-            f"IMPORTANT: You MUST invent a specific fictional company name and use it as the h1 heading. "
-            f"Do NOT use 'AI Startup', 'Our Company', 'Join Our Team', or any generic title. "
-            f"Pick something creative like 'Synapse Labs', 'Cortex AI', 'Luminary Systems', 'Apex Neural'. "
-            f"The h1 MUST be the invented company name."
-        )
+        messages = [
+            {"role": role, "content": content}
+            for turn in conversation_history
+            if (role := turn.get("role", "user")) in ("user", "assistant")
+            and isinstance(content := turn.get("content"), str)
+            and content
+        ][-MAX_HISTORY_TURNS:]
+
+        # Drop the oldest turns until the window fits the character budget, then make
+        # sure it still opens on a user turn as the Messages API expects. The latest
+        # user/assistant pair is always kept: it holds the UI a refinement builds on,
+        # and its A2UI JSON alone can exceed the budget.
+        start = 0
+        keep_from = max(len(messages) - 2, 0)
+        history_chars = sum(len(m["content"]) for m in messages)
+        while start < keep_from and history_chars > MAX_HISTORY_CHARS:
+            history_chars -= len(messages[start]["content"])
+            start += 1
+        while start < len(messages) and messages[start]["role"] != "user":
+            start += 1
+        messages = messages[start:]
+
+        # Cache through the last prior turn; the next request in this session repeats it
+        if messages:
+            messages[-1] = {
+                "role": messages[-1]["role"],
+                "content": [
+                    {"type": "text", "text": messages[-1]["content"], "cache_control": {"type": "ephemeral"}}
+                ],
+            }
+
+        # Rules 0/00 in SYSTEM_PROMPT carry the full company-name guidance; a one-line
+        # reminder at the query level is kept because it is the most reliable injection point
+        enhanced_query = f"{query}\n\nThe h1 MUST be an invented fictional company name."
         messages.append({"role": "user", "content": enhanced_query})
         return messages
 
@@ -144,21 +378,92 @@ class UIGeneratorAgent:
         max_retries = 2
         messages = self._build_messages(query, conversation_history)
 
+        # The agent is shared by every visitor and fresh prompts carry no history, so only
+        # refinements (whose history identifies the session's UI) are cached
+        cache_key = None
+        if self.use_ui and len(messages) > 1:
+            cache_key = self._cache_key(messages)
+        if cache_key is not None:
+            cached = self._cache.get(cache_key)
+            # Re-validate on recall so a schema change can never serve a stale UI
+            if cached is not None and self._validate_a2ui(cached[1]) is None:
+                logger.info("Serving A2UI response from extraction cache")
+                text_part, extracted = cached
+                yield {
+                    "is_task_complete": True,
+                    "content": self._format_a2ui(text_part, extracted),
+                }
+                return
+
+        # Partial UI is only streamed on the first attempt. If that attempt is rejected its
+        # surfaces are deleted, and retries deliver their UI in the final event alone.
+        stream_partials = self.use_ui
         for attempt in range(1, max_retries + 1):
-            logger.info(f"Attempt {attempt}/{max_retries}, history turns: {len(conversation_history)}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("Attempt %d/%d, history turns: %d", attempt, max_retries, len(conversation_history))
             yield {"is_task_complete": False, "updates": self.get_processing_message()}
 
+            response_text = ""
+            partials: list[dict] = []
             try:
-                response = self.client.messages.create(
+                streamed_len = 0
+                json_started = False
+                scanner = None
+                async with self.client.messages.stream(
                     model=self.model,
                     max_tokens=4096,
-                    system=SYSTEM_PROMPT,
+                    system=self._system_blocks,
                     messages=messages,
-                )
-                response_text = response.content[0].text
-                logger.info(f"Claude response preview: {response_text[:200]}")
+                ) as response_stream:
+                    async for text in response_stream.text_stream:
+                        response_text += text
+                        if json_started:
+                            if scanner is None:
+                                continue
+                            new_text = text
+                        elif not self.use_ui:
+                            visible = response_text
+                        else:
+                            prelude, sep, new_text = response_text.partition(A2UI_DELIMITER)
+                            if sep:
+                                json_started = True
+                                if stream_partials:
+                                    scanner = _ArrayElementScanner()
+                                if prelude.strip():
+                                    yield {"is_task_complete": False, "updates": prelude.strip()}
+                            else:
+                                # Hold back a possibly half-received delimiter
+                                visible = response_text[: -(len(A2UI_DELIMITER) - 1)]
+
+                        if not json_started:
+                            if visible and len(visible) - streamed_len >= STREAM_UPDATE_CHARS:
+                                streamed_len = len(visible)
+                                yield {"is_task_complete": False, "updates": visible.strip()}
+                        elif scanner is not None:
+                            # Forward each top-level A2UI message once it is complete and well-formed
+                            ready = []
+                            for element in scanner.feed(new_text):
+                                try:
+                                    message = orjson.loads(element)
+                                except orjson.JSONDecodeError:
+                                    message = None
+                                if self._message_error(message) is not None or (
+                                    not partials and "beginRendering" not in message
+                                ):
+                                    # Leave the rest of this attempt to the final validation
+                                    scanner = None
+                                    break
+                                partials.append(message)
+                                ready.append(message)
+                            if ready:
+                                yield {"is_task_complete": False, "a2ui_messages": ready}
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Claude response preview: %s", response_text[:200])
             except Exception as e:
                 logger.error(f"Claude API error: {e}")
+                if partials:
+                    yield self._discard_partials(partials)
+                    stream_partials = False
                 if attempt < max_retries:
                     continue
                 yield {"is_task_complete": True, "content": f"API error: {e}"}
@@ -168,24 +473,35 @@ class UIGeneratorAgent:
                 yield {"is_task_complete": True, "content": response_text}
                 return
 
-            extracted = self._extract_a2ui(response_text)
+            result = self._extract_a2ui(response_text)
 
-            if extracted is not None:
-                try:
-                    jsonschema.validate(instance=extracted, schema=self.a2ui_schema_object)
+            if result is not None:
+                text_part, extracted = result
+                error = self._validate_a2ui(extracted)
+                if error is None:
                     logger.info("A2UI JSON validated successfully")
-                    text_part = response_text.split("---a2ui_JSON---")[0].strip()
+                    if cache_key is not None:
+                        if len(self._cache) >= EXTRACTION_CACHE_SIZE:
+                            self._cache.pop(next(iter(self._cache)))
+                        self._cache[cache_key] = (text_part, extracted)
+                    # Tell the executor how many leading messages clients already have
+                    streamed = len(partials) if extracted[: len(partials)] == partials else 0
                     yield {
                         "is_task_complete": True,
-                        "content": f"{text_part}\n---a2ui_JSON---\n{json.dumps(extracted)}",
+                        "content": self._format_a2ui(text_part, extracted),
+                        "streamed_messages": streamed,
                     }
                     return
-                except jsonschema.exceptions.ValidationError as e:
-                    logger.warning(f"Schema validation failed: {e.message}")
-                    error_detail = f"Schema error: {e.message}"
+                if logger.isEnabledFor(logging.WARNING):
+                    logger.warning("Schema validation failed: %s", error)
+                error_detail = f"Schema error: {error}"
             else:
                 error_detail = "Response missing ---a2ui_JSON--- delimiter or valid JSON array"
 
+            if partials:
+                yield self._discard_partials(partials)
+                stream_partials = False
+
             # Retry with correction
             messages.append({"role": "assistant", "content": response_text})
             messages.append({
@@ -201,5 +517,76 @@ class UIGeneratorAgent:
         logger.error("All retries exhausted")
         yield {"is_task_complete": True, "content": "Unable to generate UI. Please try again."}
 
+    async def generate_batch(self, queries: list[str]) -> list[dict[str, Any]]:
+        """
+        Generate responses for many queries through the Message Batches API.
+
+        Batches cost half as much as interactive calls but can take minutes to hours,
+        so this is meant for non-interactive work such as regenerating fixtures.
+        Each query is sent without conversation history and without retries.
+
+        Returns:
+            One final event per query, in order, shaped like the last item of stream().
+        """
+        if not queries:
+            return []
+
+        batch = await self.client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": str(i),
+                    "params": {
+                        "model": self.model,
+                        "max_tokens": 4096,
+                        "system": self._system_blocks,
+                        "messages": self._build_messages(query, []),
+                    },
+                }
+                for i, query in enumerate(queries)
+            ]
+        )
+        logger.info(f"Submitted batch {batch.id} with {len(queries)} requests")
+
+        results: list[dict[str, Any]] = [
+            {"is_task_complete": True, "content": "Unable to generate UI. Please try again."}
+            for _ in queries
+        ]
+
+        # The API ends a batch by expires_at; stop polling past it rather than wait forever
+        while batch.processing_status != "ended":
+            if datetime.now(timezone.utc) >= batch.expires_at:
+                logger.error(f"Batch {batch.id} still {batch.processing_status} at expiry")
+                return results
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+
+        async for entry in await self.client.messages.batches.results(batch.id):
+            index = int(entry.custom_id)
+            if entry.result.type != "succeeded":
+                logger.warning(f"Batch request {index} {entry.result.type}")
+                continue
+
+            response_text = next(
+                (block.text for block in entry.result.message.content if block.type == "text"), None
+            )
+            if response_text is None:
+                logger.warning(f"Batch request {index} returned no text")
+                continue
+            if not self.use_ui:
+                results[index]["content"] = response_text
+                continue
+
+            result = self._extract_a2ui(response_text)
+            if result is None:
+                continue
+            text_part, extracted = result
+            error = self._validate_a2ui(extracted)
+            if error is not None:
+                logger.warning(f"Batch request {index} failed validation: {error}")
+                continue
+            results[index]["content"] = self._format_a2ui(text_part, extracted)
+
+        return results
+
 
 RestaurantAgent = UIGeneratorAgent
\ No newline at end of file
@@ -1,7 +1,7 @@
 # agent_executor.py
-import json
 import logging
 
+import orjson
 from a2a.server.agent_execution import AgentExecutor, RequestContext
 from a2a.server.events import EventQueue
 from a2a.server.tasks import TaskUpdater
@@ -21,7 +21,7 @@ from a2a.utils import (
 from a2a.utils.errors import ServerError
 
 from .a2ui_extension import create_a2ui_part, try_activate_a2ui_extension
-from .agent import UIGeneratorAgent
+from .agent import A2UI_DELIMITER, UIGeneratorAgent
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +41,10 @@ class UIGeneratorExecutor(AgentExecutor):
         use_ui = try_activate_a2ui_extension(context)
         agent = self.ui_agent if use_ui else self.text_agent
 
+        # Partial UI only reaches message/stream callers; message/send returns just the final message
+        call_context = context.call_context
+        streaming = bool(call_context and call_context.state.get("method") == "message/stream")
+
         # Extract conversation history from metadata
         conversation_history = []
         try:
@@ -88,10 +92,19 @@ class UIGeneratorExecutor(AgentExecutor):
             is_task_complete = item["is_task_complete"]
 
             if not is_task_complete:
-                await updater.update_status(
-                    TaskState.working,
-                    new_agent_text_message(item["updates"], task.context_id, task.id),
-                )
+                if "a2ui_messages" in item:
+                    if not streaming:
+                        continue
+                    # Partial UI: forward A2UI messages as soon as the agent has parsed them
+                    parts = [create_a2ui_part(message) for message in item["a2ui_messages"]]
+                    working_message = new_agent_parts_message(parts, task.context_id, task.id)
+                else:
+                    # Every status update lands in task history, so message/send callers only
+                    # get the per-attempt processing message, not the streamed text
+                    if not streaming and item["updates"] != agent.get_processing_message():
+                        continue
+                    working_message = new_agent_text_message(item["updates"], task.context_id, task.id)
+                await updater.update_status(TaskState.working, working_message)
                 continue
 
             final_state = (
@@ -101,8 +114,8 @@ class UIGeneratorExecutor(AgentExecutor):
             content = item["content"]
             final_parts = []
 
-            if "---a2ui_JSON---" in content:
-                text_content, json_string = content.split("---a2ui_JSON---", 1)
+            text_content, delimiter, json_string = content.partition(A2UI_DELIMITER)
+            if delimiter:
                 if text_content.strip():
                     final_parts.append(Part(root=TextPart(text=text_content.strip())))
                 if json_string.strip():
@@ -110,13 +123,15 @@ class UIGeneratorExecutor(AgentExecutor):
                         json_string_cleaned = (
                             json_string.strip().lstrip("```json").rstrip("```").strip()
                         )
-                        json_data = json.loads(json_string_cleaned)
+                        json_data = orjson.loads(json_string_cleaned)
                         if isinstance(json_data, list):
-                            for message in json_data:
+                            # Streaming clients already hold the messages forwarded as partial UI
+                            already_sent = item.get("streamed_messages", 0) if streaming else 0
+                            for message in json_data[already_sent:]:
                                 final_parts.append(create_a2ui_part(message))
                         else:
                             final_parts.append(create_a2ui_part(json_data))
-                    except json.JSONDecodeError as e:
+                    except orjson.JSONDecodeError as e:
                         logger.error(f"Failed to parse UI JSON: {e}")
                         final_parts.append(Part(root=TextPart(text=json_string)))
             else: